@@ -21,6 +21,16 @@ import matplotlib
 import argparse
 import os
 import sys
+import gzip
+import hashlib
+import heapq
+import bisect
+import zlib
+from array import array
+from collections import Counter
+import threading
+from queue import Queue, Full
+from multiprocessing import Pool
 from operator import itemgetter
 
 
@@ -47,6 +57,35 @@ def isfile(path):
     return path
 
 
+def kmer_size_type(value):
+    """Check if value is a kmer size or 'auto'.
+      :Parameters:
+          value: Value given to -k
+    """
+    if value == "auto":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        msg = "{0} is neither an integer nor 'auto'".format(value)
+        raise argparse.ArgumentTypeError(msg)
+
+
+def fraction_type(value):
+    """Check if value is a fraction in ]0, 1].
+      :Parameters:
+          value: Value given to --sample-fraction
+    """
+    try:
+        fraction = float(value)
+    except ValueError:
+        fraction = None
+    if fraction is None or not 0 < fraction <= 1:
+        msg = "{0} is not a fraction in ]0, 1]".format(value)
+        raise argparse.ArgumentTypeError(msg)
+    return fraction
+
+
 def get_arguments():
     """Retrieves the arguments of the program.
       Returns: An object that contains the arguments
@@ -56,9 +95,30 @@ def get_arguments():
                                      "{0} -h"
                                      .format(sys.argv[0]))
     parser.add_argument('-i', dest='fastq_file', type=isfile,
-                        required=True, help="Fastq file")
-    parser.add_argument('-k', dest='kmer_size', type=int,
-                        default=21, help="K-mer size (default 21)")
+                        required=True, help="Fastq file, gzipped or not")
+    parser.add_argument('-k', dest='kmer_size', type=kmer_size_type,
+                        default=21, help="K-mer size or 'auto' to select it "
+                        "from a sample of the reads (default 21)")
+    parser.add_argument('--sample-fraction', dest='sample_fraction',
+                        type=fraction_type, default=0.1, help="Fraction of "
+                        "the reads first sampled by -k auto, doubled up to "
+                        "0.5 while too small (default 0.1)")
+    parser.add_argument('--correct', dest='correct', action='store_true',
+                        help="Correct the reads before the assembly")
+    parser.add_argument('--min-count', dest='min_count', type=int,
+                        default=None, help="Minimal count of a solid kmer "
+                        "for the read correction and the implicit graph "
+                        "(default 2, or estimated with -k auto)")
+    parser.add_argument('-t', dest='nb_process', type=int, default=1,
+                        help="Number of processes for the read correction "
+                        "(default 1)")
+    parser.add_argument('--pipeline', dest='pipeline', action='store_true',
+                        help="Read the file in a separate thread while "
+                        "the kmers are counted")
+    parser.add_argument('--implicit', dest='implicit', action='store_true',
+                        help="Assemble on a graph stored in a Bloom filter "
+                        "(a few bytes per kmer); the kmer counts are still "
+                        "held in memory while the graph is built")
     parser.add_argument('-o', dest='output_file', type=str,
                         default=os.curdir + os.sep + "contigs.fasta",
                         help="Output contigs in fasta file")
@@ -66,12 +126,21 @@ def get_arguments():
 
 
 
+def open_fastq(fastq_file):
+    """Open the file for reading as text, gzipped or not.
+      :Parameters:
+         fastq_file : Path to the file
+    """
+    if fastq_file.endswith(".gz"):
+        return gzip.open(fastq_file, 'rt')
+    return open(fastq_file, 'r')
+
 def read_fastq(fastq_file):
-    """Generator reading sequences contained in the file.
+    """Generator reading sequences contained in the file, gzipped or not.
       :Parameters:
          fastq_file : Path to the file
     """
-    with open(fastq_file, 'r') as f:
+    with open_fastq(fastq_file) as f:
         while True:
             line = f.readline()
             if len(line) ==0 :
@@ -96,8 +165,16 @@ def build_kmer_dict(fastq_file, kmer_size):
          fastq_file : Path of the file
          kmer_size : size of the kmer
     """
+    return build_kmer_dict_from_reads(read_fastq(fastq_file), kmer_size)
+
+def build_kmer_dict_from_reads(reads, kmer_size):
+    """Create a kmer dictionnary based on the given sequences with the specified size.
+      :Parameters:
+         reads : iterable of sequences
+         kmer_size : size of the kmer
+    """
     dic = {}
-    for i in read_fastq(fastq_file):
+    for i in reads:
         for j in cut_kmer(i,kmer_size):
             try:
                 dic[j] +=1
@@ -105,6 +182,299 @@ def build_kmer_dict(fastq_file, kmer_size):
                 dic[j] = 1
     return dic
 
+def build_kmer_dict_pipelined(fastq_file, kmer_size, queue_size=8,
+                              block_size=1 << 20):
+    """Create a kmer dictionnary like build_kmer_dict, a reader thread reading
+    (and decompressing) blocks of lines of the file while the calling thread
+    extracts their sequences and counts the kmers. The queue between them
+    holds at most queue_size blocks, so the reader waits for the counter
+    when it gets ahead, and stops if counting fails.
+      :Parameters:
+         fastq_file : Path of the file
+         kmer_size : size of the kmer
+         queue_size : maximal number of blocks waiting to be counted
+         block_size : approximate number of characters in a block
+    """
+    blocks = Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def reader():
+        try:
+            with open_fastq(fastq_file) as f:
+                while True:
+                    lines = f.readlines(block_size)
+                    if not lines or not put(lines):
+                        return
+        except Exception as error:
+            errors.append(error)
+        finally:
+            put(None)
+
+    def sequences():
+        leftover = []
+        while True:
+            lines = blocks.get()
+            if lines is None:
+                break
+            # a block may end in the middle of a record
+            lines = leftover + lines
+            end = len(lines) - len(lines) % 4
+            leftover = lines[end:]
+            for line in lines[1:end:4]:
+                yield line[:-1]
+        # truncated last record, as read by read_fastq
+        if leftover:
+            yield leftover[1][:-1] if len(leftover) > 1 else ""
+
+    reader_thread = threading.Thread(target=reader, daemon=True)
+    reader_thread.start()
+    try:
+        dic = build_kmer_dict_from_reads(sequences(), kmer_size)
+    finally:
+        stop.set()
+        reader_thread.join()
+    if errors:
+        raise errors[0]
+    return dic
+
+def sample_reads(fastq_file, fraction, max_reads=100000):
+    """Return (sample, fraction covered) for a random sample of the sequences
+    contained in the file, read once. Each sequence draws a priority in
+    [0, 1[ and is kept when it is below fraction; only the max_reads lowest
+    priorities are kept, which lowers the fraction covered. The sample is a
+    list of (priority, sequence) sorted by priority, so the sample of any
+    smaller fraction is one of its prefixes.
+      :Parameters:
+         fastq_file : Path to the file
+         fraction : probability for each sequence to be kept
+         max_reads : maximal number of sequences kept
+    """
+    heap = []
+    for read in read_fastq(fastq_file):
+        priority = random.random()
+        if priority >= fraction:
+            continue
+        if len(heap) < max_reads:
+            heapq.heappush(heap, (-priority, read))
+        elif priority < -heap[0][0]:
+            heapq.heapreplace(heap, (-priority, read))
+    if len(heap) == max_reads:
+        fraction = -heap[0][0]
+    return sorted((-priority, read) for priority, read in heap), fraction
+
+def kmer_histogram(reads, kmer_size, max_size=1 << 24):
+    """Return the abundance histogram of the kmers of the sequences as a
+    dictionnary {count: number of kmers}. The kmers are counted in a table
+    of one byte counters (saturating at 255) indexed by the crc32 of the
+    kmer, with four counters per kmer of the sequences up to max_size, so
+    that few kmers share a counter.
+      :Parameters:
+         reads : list of sequences
+         kmer_size : size of the kmer
+         max_size : maximal number of counters
+    """
+    nb_kmer = sum(max(0, len(read) - kmer_size + 1) for read in reads)
+    size = max(1, min(4 * nb_kmer, max_size))
+    counts = array('B', bytes(size))
+    for read in reads:
+        for kmer in cut_kmer(read, kmer_size):
+            i = zlib.crc32(kmer.encode()) % size
+            if counts[i] < 255:
+                counts[i] += 1
+    histogram = Counter(counts)
+    del histogram[0]
+    return dict(histogram)
+
+def analyse_histogram(histogram):
+    """Return (cutoff, peak, genome size) of a kmer histogram, the cutoff
+    being the first minimum separating erroneous kmers from solid ones, the
+    peak the most frequent count above it and the genome size the number of
+    distinct solid kmers, or None when the histogram has no such minimum.
+    A histogram rising from count 1 shows no errors to separate, and a
+    minimum above which lie less than half of the kmer occurrences is only
+    noise in the tail of the errors.
+      :Parameters:
+         histogram : dictionnary {count: number of kmers}
+    """
+    max_count = max(histogram, default=0)
+    cutoff = None
+    for count in range(1, max_count):
+        if histogram.get(count, 0) < histogram.get(count + 1, 0):
+            cutoff = count
+            break
+    if cutoff is None or cutoff == 1:
+        return None
+    occurrences = sum(count * number for count, number in histogram.items())
+    solid_occurrences = sum(count * number
+                            for count, number in histogram.items()
+                            if count >= cutoff)
+    if 2 * solid_occurrences < occurrences:
+        return None
+    peak = max(range(cutoff, max_count + 1),
+               key=lambda count: histogram.get(count, 0))
+    genome_size = sum(number for count, number in histogram.items()
+                      if count >= cutoff)
+    return (cutoff, peak, genome_size)
+
+def select_kmer_size(fastq_file, fraction=0.1,
+                     candidates=(15, 21, 27, 33, 41, 51, 61),
+                     max_fraction=0.5, max_reads=100000):
+    """Return (kmer size, minimal count, genome size) chosen from the
+    histograms of a sample of the reads. The file is read once, keeping at
+    most max_reads sequences from max(fraction, max_fraction) of it. The
+    sampled fraction is doubled until the histogram of the smallest
+    candidate separates errors from solid kmers; the histograms of all the
+    candidates are then built, the kmer size giving the most distinct solid
+    kmers is kept and its cutoff is scaled to the whole file. The default
+    kmer size and minimal count are returned with a genome size of 0, and a
+    warning, when the sample never shows such a separation.
+      :Parameters:
+         fastq_file : Path to the file
+         fraction : fraction of the reads sampled first
+         candidates : kmer sizes tested
+         max_fraction : fraction of the reads the sample can grow to
+         max_reads : maximal number of sequences sampled
+    """
+    if not 0 < fraction <= 1:
+        raise ValueError("fraction must be in ]0, 1], got {0}".format(fraction))
+    sample, sampled = sample_reads(fastq_file, max(fraction, max_fraction),
+                                   max_reads)
+    priorities = [priority for priority, _ in sample]
+    min_length = min((len(read) for _, read in sample), default=0)
+    candidates = [kmer_size for kmer_size in candidates
+                  if kmer_size < min_length]
+    fraction = min(fraction, sampled)
+    while candidates:
+        reads = [read for _, read in
+                 sample[:bisect.bisect_left(priorities, fraction)]]
+        if analyse_histogram(kmer_histogram(reads, candidates[0])) is not None:
+            best = None
+            best_solid = 0
+            for kmer_size in candidates:
+                analysis = analyse_histogram(kmer_histogram(reads, kmer_size))
+                if analysis is None:
+                    continue
+                cutoff, peak, genome_size = analysis
+                if genome_size > best_solid:
+                    min_count = max(2, min(round(cutoff / fraction),
+                                           round(peak / fraction / 2)))
+                    best = (kmer_size, min_count, genome_size)
+                    best_solid = genome_size
+            return best
+        if fraction >= sampled:
+            break
+        fraction = min(2 * fraction, sampled)
+    print("No kmer histogram of the sample separates errors from solid "
+          "kmers, using kmer size 21 and min count 2", file=sys.stderr)
+    return (21, 2, 0)
+
+def correct_read(read, kmer_dict, kmer_size, min_count):
+    """Return the read where single bases are replaced so that its weak kmers
+    (seen less than min_count times) become solid. Positions covered by the
+    most weak kmers are tried first, and the read is returned unchanged if
+    it cannot be fully corrected.
+      :Parameters:
+         read : sequence
+         kmer_dict : kmer dictionnary of the uncorrected reads
+         kmer_size : size of the kmer
+         min_count : minimal count for a kmer to be solid
+    """
+    def is_solid(seq, first, last):
+        for i in range(first, last + 1):
+            if kmer_dict.get(seq[i:i+kmer_size], 0) < min_count:
+                return False
+        return True
+
+    weak = [i for i, kmer in enumerate(cut_kmer(read, kmer_size))
+            if kmer_dict.get(kmer, 0) < min_count]
+    corrected = read
+    for _ in range(len(weak)):
+        if not weak:
+            return corrected
+        coverage = {}
+        for i in weak:
+            for pos in range(i, i + kmer_size):
+                coverage[pos] = coverage.get(pos, 0) + 1
+        fixed = False
+        for pos, _ in sorted(coverage.items(), key=itemgetter(1), reverse=True):
+            first = max(0, pos - kmer_size + 1)
+            last = min(pos, len(corrected) - kmer_size)
+            for base in "ACGT":
+                if base == corrected[pos]:
+                    continue
+                candidate = corrected[:pos] + base + corrected[pos+1:]
+                if is_solid(candidate, first, last):
+                    corrected = candidate
+                    fixed = True
+                    break
+            if fixed:
+                break
+        if not fixed:
+            return read
+        weak = [i for i in weak if not first <= i <= last]
+    return corrected if not weak else read
+
+
+_correction_args = None
+
+
+def _init_correction(kmer_dict, kmer_size, min_count):
+    """Share the correction parameters with a worker process."""
+    global _correction_args
+    _correction_args = (kmer_dict, kmer_size, min_count)
+
+
+def _correct_batch(batch):
+    """Return the corrected sequences of a batch."""
+    return [correct_read(read, *_correction_args) for read in batch]
+
+
+def _batches(reads, batch_size):
+    """Generator grouping the sequences into lists of batch_size sequences."""
+    batch = []
+    for read in reads:
+        batch.append(read)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def correct_reads(fastq_file, kmer_dict, kmer_size, min_count=2,
+                  nb_process=1, batch_size=1000):
+    """Generator yielding the corrected sequences of the file, processed by
+    batches in nb_process processes.
+      :Parameters:
+         fastq_file : Path to the file
+         kmer_dict : kmer dictionnary of the file
+         kmer_size : size of the kmer
+         min_count : minimal count for a kmer to be solid
+         nb_process : number of processes
+         batch_size : number of reads sent to a process at once
+    """
+    batches = _batches(read_fastq(fastq_file), batch_size)
+    if nb_process <= 1:
+        for batch in batches:
+            for read in batch:
+                yield correct_read(read, kmer_dict, kmer_size, min_count)
+        return
+    with Pool(nb_process, _init_correction,
+              (kmer_dict, kmer_size, min_count)) as pool:
+        for batch in pool.imap(_correct_batch, batches):
+            yield from batch
+
+
 def build_graph(kmer_dict):
     """Return the corresponding oriented graph of a kmer dictionnary.
       :Parameters:
@@ -115,6 +485,124 @@ def build_graph(kmer_dict):
         graph.add_edge(key[:-1],key[1:],weight=kmer_dict[key])
     return graph
 
+class BloomFilter:
+    """Bit array answering approximate membership queries for kmers.
+      :Parameters:
+         capacity : expected number of inserted kmers
+         bits_per_kmer : size of the bit array per expected kmer
+         nb_hash : number of hash functions
+    """
+    def __init__(self, capacity, bits_per_kmer=10, nb_hash=7):
+        self.size = max(8, capacity * bits_per_kmer)
+        self.nb_hash = nb_hash
+        self.bits = bytearray((self.size + 7) // 8)
+
+    @staticmethod
+    def _hashes(kmer):
+        digest = int.from_bytes(hashlib.blake2b(kmer.encode(),
+                                                digest_size=8).digest(),
+                                "little")
+        return digest & 0xffffffff, (digest >> 32) | 1
+
+    def add(self, kmer):
+        """Insert the kmer in the filter."""
+        h1, h2 = self._hashes(kmer)
+        for i in range(self.nb_hash):
+            pos = (h1 + i * h2) % self.size
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, kmer):
+        h1, h2 = self._hashes(kmer)
+        size = self.size
+        bits = self.bits
+        for i in range(self.nb_hash):
+            pos = (h1 + i * h2) % size
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class ImplicitDebruijnGraph:
+    """De Bruijn graph whose edges (the kmers) are stored in a Bloom filter.
+    Successors and predecessors are found by querying the four possible
+    bases, the critical false positives being excluded. Only the nodes
+    without exactly one ancestor and one successor are kept, so they are the
+    only ones enumerated by nodes().
+      :Parameters:
+         bloom : Bloom filter of the solid kmers
+         critical_fp : set of kmers wrongly accepted by the filter
+         branching_nodes : list of the nodes without exactly one ancestor
+         and one successor
+    """
+    def __init__(self, bloom, critical_fp, branching_nodes):
+        self.bloom = bloom
+        self.critical_fp = critical_fp
+        self.branching_nodes = branching_nodes
+
+    def has_edge(self, node, next_node):
+        """Return True if the graph has an edge from node to next_node."""
+        if node[1:] != next_node[:-1]:
+            return False
+        kmer = node + next_node[-1]
+        return kmer in self.bloom and kmer not in self.critical_fp
+
+    def successors(self, node):
+        """Generator yielding the successors of the node."""
+        for base in "ACGT":
+            kmer = node + base
+            if kmer in self.bloom and kmer not in self.critical_fp:
+                yield kmer[1:]
+
+    def predecessors(self, node):
+        """Generator yielding the ancestors of the node."""
+        for base in "ACGT":
+            kmer = base + node
+            if kmer in self.bloom and kmer not in self.critical_fp:
+                yield kmer[:-1]
+
+    def nodes(self):
+        """Return the nodes without exactly one ancestor and one successor."""
+        return iter(self.branching_nodes)
+
+
+def build_implicit_graph(kmer_dict, min_count=2, bits_per_kmer=10):
+    """Return the implicit graph of the kmers seen at least min_count times.
+    The kmer dictionnary is only needed during construction, to find the
+    critical false positives and the branching nodes: the memory used while
+    building is the one of the dictionnary, only the assembly that follows
+    runs in a few bytes per kmer.
+      :Parameters:
+         kmer_dict : kmer dictionnary
+         min_count : minimal count for a kmer to be solid
+         bits_per_kmer : size of the Bloom filter per kmer
+    """
+    solid = [kmer for kmer, count in kmer_dict.items() if count >= min_count]
+    bloom = BloomFilter(len(solid), bits_per_kmer)
+    for kmer in solid:
+        bloom.add(kmer)
+    critical_fp = set(kmer for kmer, count in kmer_dict.items()
+                      if count < min_count and kmer in bloom)
+    branching_nodes = []
+    nodes = set(kmer[:-1] for kmer in solid)
+    nodes.update(kmer[1:] for kmer in solid)
+    for node in nodes:
+        degrees = []
+        for neighbours in ([base + node for base in "ACGT"],
+                           [node + base for base in "ACGT"]):
+            degree = 0
+            for neighbour in neighbours:
+                count = kmer_dict.get(neighbour)
+                if count is None:
+                    if neighbour in bloom:
+                        critical_fp.add(neighbour)
+                elif count >= min_count:
+                    degree += 1
+            degrees.append(degree)
+        if degrees != [1, 1]:
+            branching_nodes.append(node)
+    return ImplicitDebruijnGraph(bloom, critical_fp, sorted(branching_nodes))
+
+
 def remove_paths(graph, path_list, delete_entry_node, delete_sink_node):
     """qui prend un graphe et une liste de chemin,
     la variable booléenne delete_entry_node pour indiquer si les noeuds d’entrée
@@ -361,6 +849,51 @@ def get_contig(graph, starting_node, ending):
     else:
         return 'FALSE'
 
+def is_internal(graph, node):
+    """Return True if the node has exactly one ancestor and one successor.
+      :Parameters:
+         graph : the graph
+         node : the node
+    """
+    return len(list(graph.predecessors(node))) == 1 and \
+        len(list(graph.successors(node))) == 1
+
+def get_unitig(graph, starting_node, next_node):
+    """Return the unitig of the graph beginning with the edge from
+    starting_node to next_node, walking forward through the nodes with
+    exactly one ancestor and one successor.
+      :Parameters:
+         graph : the graph
+         starting_node : the node that will be used as start position in the graph
+         next_node : the successor of starting_node the unitig goes through
+    """
+    unitig = starting_node + next_node[-1]
+    node = next_node
+    while node != starting_node:
+        successors = list(graph.successors(node))
+        if len(successors) != 1 or len(list(graph.predecessors(node))) != 1:
+            break
+        node = successors[0]
+        unitig += node[-1]
+    return unitig
+
+def get_unitigs(graph):
+    """Return the unitigs of the graph as tuple formed as
+    (unitig,len of the unitig). A unitig is started on every edge leaving a
+    node that does not have exactly one ancestor and one successor, so the
+    paths after a branch are kept and every edge is in one unitig.
+      :Parameters:
+         graph : the graph
+    """
+    unitigs = []
+    for n in graph.nodes():
+        if is_internal(graph, n):
+            continue
+        for successor in graph.successors(n):
+            u = get_unitig(graph, n, successor)
+            unitigs.append((u, len(u)))
+    return unitigs
+
 def get_contigs(graph, starting_nodes, ending_nodes):
     """Return the contigs of the graph as tuple formed as
     (contig,len of the contig) for the specified starting nodes and ending nodes.
@@ -408,7 +941,30 @@ def main():
     pass
     # Get arguments
     args = get_arguments()
-    kmer_dict = build_kmer_dict(args.fastq_file,args.kmer_size)
+    if args.kmer_size == "auto":
+        kmer_size, min_count, genome_size = select_kmer_size(
+            args.fastq_file, args.sample_fraction)
+        print("kmer size {0}, min count {1}, genome size {2}".format(
+            kmer_size, min_count, genome_size))
+        args.kmer_size = kmer_size
+        if args.min_count is None:
+            args.min_count = min_count
+    if args.min_count is None:
+        args.min_count = 2
+    if args.pipeline:
+        kmer_dict = build_kmer_dict_pipelined(args.fastq_file,args.kmer_size)
+    else:
+        kmer_dict = build_kmer_dict(args.fastq_file,args.kmer_size)
+    if args.correct:
+        reads = correct_reads(args.fastq_file,kmer_dict,args.kmer_size,
+                              args.min_count,args.nb_process)
+        kmer_dict = build_kmer_dict_from_reads(reads,args.kmer_size)
+    if args.implicit:
+        graph = build_implicit_graph(kmer_dict,args.min_count)
+        del kmer_dict
+        contig_list = get_unitigs(graph)
+        save_contigs(contig_list,args.output_file)
+        return
     graph = build_graph(kmer_dict)
     graph = simplify_bubbles(graph)
     #graph = solve_entry_tips(graph,get_starting_nodes(graph))
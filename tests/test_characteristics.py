@@ -8,6 +8,7 @@ from .context import debruijn
 from debruijn import get_starting_nodes
 from debruijn import get_sink_nodes
 from debruijn import get_contigs
+from debruijn import get_unitigs
 from debruijn import save_contigs
 
 
@@ -37,6 +38,15 @@ def test_get_contigs():
         assert contig[0] in results
         assert contig[1] == 8
 
+def test_get_unitigs():
+    graph = nx.DiGraph()
+    graph.add_edges_from([("TC", "CA"), ("CA", "AG"), ("AG", "GC"), ("GC", "CG"), ("CG", "GA"), ("GA", "AT"), ("GA", "AA")])
+    unitig_list = get_unitigs(graph)
+    assert len(unitig_list) == 3
+    assert ("TCAGCGA", 7) in unitig_list
+    assert ("GAT", 3) in unitig_list
+    assert ("GAA", 3) in unitig_list
+
 
 # def test_get_contigs_comp():
 #     graph = nx.DiGraph()
@@ -8,7 +8,15 @@ from .context import debruijn
 from debruijn import read_fastq
 from debruijn import cut_kmer
 from debruijn import build_kmer_dict
+from debruijn import build_kmer_dict_pipelined
 from debruijn import build_graph
+from debruijn import build_implicit_graph
+from debruijn import correct_read
+from debruijn import correct_reads
+from debruijn import kmer_histogram
+from debruijn import analyse_histogram
+from debruijn import select_kmer_size
+from debruijn import sample_reads
 
 
 def test_read_fastq():
@@ -35,6 +43,28 @@ def test_build_kmer_dict():
     assert "GAG" in kmer_dict
     assert kmer_dict["AGA"] == 2
 
+def test_build_kmer_dict_pipelined():
+    fastq_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "test_two_reads.fq"))
+    kmer_dict = build_kmer_dict(fastq_file, 5)
+    assert build_kmer_dict_pipelined(fastq_file, 5) == kmer_dict
+    assert build_kmer_dict_pipelined(fastq_file, 5, queue_size=1, block_size=1) == kmer_dict
+    # the reader stops when counting fails
+    with pytest.raises(TypeError):
+        build_kmer_dict_pipelined(fastq_file, None, queue_size=1, block_size=1)
+    with pytest.raises(FileNotFoundError):
+        build_kmer_dict_pipelined(fastq_file + ".missing", 5)
+
+def test_build_kmer_dict_pipelined_truncated(tmp_path):
+    fastq_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "test_two_reads.fq"))
+    with open(fastq_file) as f:
+        lines = f.readlines()
+    for nb_line in range(5, 8):
+        truncated = str(tmp_path / "truncated_{0}.fq".format(nb_line))
+        with open(truncated, "w") as f:
+            f.writelines(lines[:nb_line])
+        assert build_kmer_dict_pipelined(truncated, 5, block_size=1) == \
+            build_kmer_dict(truncated, 5)
+
 def test_build_graph():
     file = open(os.path.abspath(os.path.join(os.path.dirname(__file__), "kmer.pck")),'rb')
     kmer_dict = pickle.load(file)
@@ -52,6 +82,87 @@ def test_build_graph():
     assert graph.edges["AG", "GA"]['weight'] == 2
     file.close()
 
+def test_build_implicit_graph():
+    fastq_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "test_build.fq"))
+    kmer_dict = build_kmer_dict(fastq_file, 3)
+    graph = build_implicit_graph(kmer_dict, min_count=1)
+    #TCAGAGA
+    assert list(graph.successors("TC")) == ["CA"]
+    assert sorted(graph.predecessors("AG")) == ["CA", "GA"]
+    assert list(graph.predecessors("TC")) == []
+    assert graph.has_edge("AG", "GA")
+    assert not graph.has_edge("GA", "AT")
+    assert not graph.has_edge("TC", "GA")
+    # only AGA is solid, the other neighbours of its nodes are either missed
+    # by the filter or critical false positives
+    solid_graph = build_implicit_graph(kmer_dict)
+    assert list(solid_graph.predecessors("GA")) == ["AG"]
+    assert list(solid_graph.successors("GA")) == []
+    assert not solid_graph.has_edge("TC", "CA")
+    assert not solid_graph.has_edge("CA", "AG")
+    assert sorted(graph.nodes()) == ["AG", "TC"]
+    for kmer in graph.critical_fp:
+        assert kmer not in kmer_dict
+
+def test_correct_read():
+    kmer_dict = {"TCA": 5, "CAG": 5, "AGA": 5, "GAG": 5, "CTG": 1, "TGA": 1}
+    assert correct_read("TCAGAGA", kmer_dict, 3, 2) == "TCAGAGA"
+    assert correct_read("TCTGAGA", kmer_dict, 3, 2) == "TCAGAGA"
+    # no single substitution makes every kmer solid
+    assert correct_read("TTTTTTT", kmer_dict, 3, 2) == "TTTTTTT"
+
+def test_kmer_histogram():
+    histogram = kmer_histogram(["TCAGAGA"], 3)
+    assert histogram == {1: 3, 2: 1}
+
+def test_analyse_histogram():
+    histogram = {1: 100, 2: 20, 3: 5, 4: 10, 5: 30, 6: 40, 7: 20, 8: 5}
+    cutoff, peak, genome_size = analyse_histogram(histogram)
+    assert cutoff == 3
+    assert peak == 6
+    assert genome_size == 5 + 10 + 30 + 40 + 20 + 5
+    assert analyse_histogram({1: 100, 2: 20, 3: 5}) is None
+    assert analyse_histogram({1: 10, 2: 20, 3: 5}) is None
+    # the tail of the errors is not a peak of solid kmers
+    assert analyse_histogram({1: 1870, 2: 874, 3: 362, 4: 112, 5: 28, 6: 2, 7: 4}) is None
+
+def test_sample_reads():
+    fastq_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "test_two_reads.fq"))
+    sample, fraction = sample_reads(fastq_file, 1)
+    assert fraction == 1
+    assert sorted(read for _, read in sample) == sorted(read_fastq(fastq_file))
+    sample, fraction = sample_reads(fastq_file, 1, max_reads=1)
+    assert len(sample) == 1
+    assert sample[0][0] == fraction
+
+def test_select_kmer_size():
+    fastq_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "data", "eva71_plus_perfect.fq"))
+    kmer_size, min_count, genome_size = select_kmer_size(fastq_file, 1)
+    assert kmer_size in (15, 21, 27, 33, 41, 51, 61)
+    assert min_count >= 2
+    assert abs(genome_size - 7408) < 740
+    # about 9x coverage: half of the reads do not show the errors apart
+    assert select_kmer_size(fastq_file, 0.1) == (21, 2, 0)
+    fastq_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "test_two_reads.fq"))
+    assert select_kmer_size(fastq_file, 0.01) == (21, 2, 0)
+    with pytest.raises(ValueError):
+        select_kmer_size(fastq_file, 0)
+
+def test_correct_reads():
+    fastq_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "test_two_reads.fq"))
+    first, second = read_fastq(fastq_file)
+    # the counts support a T at position 50 of the first read
+    expected = [first[:50] + "T" + first[51:], second]
+    kmer_dict = {}
+    for read in expected:
+        for kmer in cut_kmer(read, 21):
+            kmer_dict[kmer] = 5
+    assert first[50] != "T"
+    for nb_process in (1, 2):
+        reads = correct_reads(fastq_file, kmer_dict, 21, min_count=2,
+                              nb_process=nb_process, batch_size=1)
+        assert list(reads) == expected
+
 # def test_build_graph_comp():
 #     file = open(os.path.abspath(os.path.join(os.path.dirname(__file__), "kmer_comp.pck")),'rb')
 #     kmer_dict = pickle.load(file)